@@ -0,0 +1,47 @@
+from typing import Optional
+from pydantic import BaseModel, ConfigDict, Field
+from dotenv import load_dotenv
+import os
+
+load_dotenv()
+
+class Settings(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    auth_secret: Optional[str] = Field(None, alias="AUTH_SECRET")
+    algorithm: Optional[str] = Field(None, alias="ALGORITHM")
+    api_key: Optional[str] = Field(None, alias="API_KEY")
+    auth_url: Optional[str] = Field(None, alias="AUTH_URL")
+    redis_url: Optional[str] = Field(None, alias="REDIS_URL")
+    websocket_timeout: int = Field(..., alias="WEBSOCKET_TIMEOUT")
+
+    chat_db: str = Field("pychat.db", alias="CHAT_DB")
+    archive_db: str = Field("pychat_archive.db", alias="ARCHIVE_DB")
+    chat_retention_days: int = Field(30, alias="CHAT_RETENTION_DAYS")
+    archive_interval: int = Field(3600, alias="ARCHIVE_INTERVAL")
+    archive_batch_size: int = Field(1000, alias="ARCHIVE_BATCH_SIZE")
+    # Uploads are written before their chat row is committed, so leave young files alone
+    orphan_grace_period: int = Field(3600, alias="ORPHAN_GRACE_PERIOD")
+
+    # Base64 of a 5 MB image plus the JSON envelope
+    max_frame_size: int = Field(7 * 1024 * 1024, alias="MAX_FRAME_SIZE")
+    typing_coalesce_window: float = Field(1.0, alias="TYPING_COALESCE_WINDOW")
+    drain_reconnect_window: float = Field(30, alias="DRAIN_RECONNECT_WINDOW")
+    resume_token_ttl: int = Field(300, alias="RESUME_TOKEN_TTL")
+    # Separate from API_KEY, which clients hold; /drain is refused while unset
+    drain_key: Optional[str] = Field(None, alias="DRAIN_KEY")
+
+    host: str = Field("0.0.0.0", alias="HOST")
+    port: int = Field(8000, alias="PORT")
+    workers: int = Field(os.cpu_count() or 1, alias="WEB_CONCURRENCY")
+    loop: str = Field("uvloop", alias="UVICORN_LOOP")
+    http: str = Field("httptools", alias="UVICORN_HTTP")
+    graceful_shutdown_timeout: int = Field(30, alias="GRACEFUL_SHUTDOWN_TIMEOUT")
+
+    db_user: Optional[str] = Field(None, alias="DB_USER")
+    db_pwd: Optional[str] = Field(None, alias="DB_PWD")
+    db_name: Optional[str] = Field(None, alias="DB_NAME")
+    db_host: Optional[str] = Field(None, alias="DB_HOST")
+    db_port: Optional[str] = Field(None, alias="DB_PORT")
+
+settings = Settings.model_validate(dict(os.environ))
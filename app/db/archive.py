@@ -0,0 +1,201 @@
+import asyncio
+import fcntl
+import os
+import time
+import zlib
+from app.config import settings
+
+STATIC_DIR = "./static"
+# Pages freed per incremental_vacuum step; keeps each step short on the shared connection
+COMPACT_STEP = 256
+# zlib's header and checksum make short messages bigger; below this they are stored as plain text
+COMPRESS_MIN_SIZE = 128
+
+
+class ChatArchiver:
+    def __init__(self, db):
+        self.db = db
+        self.task = None
+        self.lock_file = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.lock_file:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def _acquire_lock(self) -> bool:
+        # Every worker starts an archiver; only the one holding the lock on this chat db works,
+        # and another takes over once it exits and the lock is released
+        if self.lock_file:
+            return True
+        lock_file = open(f"{settings.chat_db}.archiver.lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                if not self._acquire_lock():
+                    await asyncio.sleep(settings.archive_interval)
+                    continue
+                moved = await self.archive_old_messages()
+                if moved:
+                    print(f"Archived {moved} chat messages to cold storage")
+                    await self.compact()
+                removed = await self.collect_orphaned_images()
+                if removed:
+                    print(f"Removed {removed} orphaned images")
+            except Exception as e:
+                print(f"Chat archival failed: {e}")
+            await asyncio.sleep(settings.archive_interval)
+
+    async def archive_old_messages(self) -> int:
+        cutoff = int(time.time()) - settings.chat_retention_days * 86400
+        # Archive a prefix by id: /sync reads everything below the oldest hot seq from the
+        # archive, so a row must never leave hot while an earlier one in its conversation stays
+        async with self.db.execute("SELECT MAX(id) FROM chat WHERE created_at < ?", (cutoff,)) as cursor:
+            last_id = (await cursor.fetchone())[0]
+        if last_id is None:
+            return 0
+        query = '''
+            SELECT id, sender_id, receiver_id, timestamp, uuid, image, message, seq
+            FROM chat
+            WHERE id <= ?
+            ORDER BY id
+            LIMIT ?
+        '''
+        moved = 0
+        while True:
+            async with self.db.execute(query, (last_id, settings.archive_batch_size)) as cursor:
+                rows = await cursor.fetchall()
+            if not rows:
+                break
+            # A commit across attached WAL databases is not atomic, so make the archive copy
+            # durable first and only delete hot rows that are known to be in it
+            try:
+                await self.db.executemany(
+                    '''
+                    INSERT OR IGNORE INTO cold.chat_archive(id, sender_id, receiver_id, timestamp, uuid, image, message, seq)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ''',
+                    [(*row[:6], self._compress(row[6]), row[7]) for row in rows]
+                )
+                await self.db.commit()
+                await self.db.executemany(
+                    '''
+                    DELETE FROM chat
+                    WHERE id = ? AND EXISTS (SELECT 1 FROM cold.chat_archive WHERE chat_archive.id = chat.id)
+                    ''',
+                    [(row[0],) for row in rows]
+                )
+                await self.db.commit()
+            except Exception:
+                await self.db.rollback()
+                raise
+            moved += len(rows)
+            if len(rows) < settings.archive_batch_size:
+                break
+            # Let queued chat writes through between batches
+            await asyncio.sleep(0)
+        return moved
+
+    async def compact(self):
+        freed = 0
+        previous = None
+        while True:
+            async with self.db.execute("PRAGMA main.freelist_count") as cursor:
+                freelist_count = (await cursor.fetchone())[0]
+            # Stop when done, or if the file isn't in incremental auto_vacuum mode
+            if not freelist_count or freelist_count == previous:
+                break
+            if previous is not None:
+                freed += previous - freelist_count
+            previous = freelist_count
+            # execute() steps the pragma once and frees a single page; executescript runs it to completion
+            await self.db.executescript(f"PRAGMA main.incremental_vacuum({COMPACT_STEP});")
+            await asyncio.sleep(0)
+        if freed:
+            print(f"Released {freed} free pages from hot chat storage")
+
+    async def load_chat(self, user_id: int, before: int, limit: int) -> list:
+        query = '''
+            SELECT id, sender_id, receiver_id, message, timestamp, uuid, image, seq
+            FROM cold.chat_archive
+            WHERE (sender_id = ? OR receiver_id = ?) AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+        '''
+        async with self.db.execute(query, (user_id, user_id, before, limit)) as cursor:
+            rows = await cursor.fetchall()
+        return [(row[0], row[1], row[2], self._decompress(row[3]), *row[4:]) for row in rows]
+
+    async def sync_chat(self, user_id: int, peer_id: int, since: int, until: int, limit: int) -> list:
+        query = '''
+            SELECT id, sender_id, receiver_id, message, timestamp, uuid, image, seq
+            FROM cold.chat_archive
+            WHERE ((sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?))
+            AND seq > ? AND seq < ?
+            ORDER BY seq
+            LIMIT ?
+        '''
+        async with self.db.execute(query, (user_id, peer_id, peer_id, user_id, since, until, limit)) as cursor:
+            rows = await cursor.fetchall()
+        return [(row[0], row[1], row[2], self._decompress(row[3]), *row[4:]) for row in rows]
+
+    async def collect_orphaned_images(self) -> int:
+        query = '''
+            SELECT image FROM chat WHERE image IS NOT NULL
+            UNION SELECT image FROM cold.chat_archive WHERE image IS NOT NULL
+            UNION SELECT profileimage FROM users
+        '''
+        async with self.db.execute(query) as cursor:
+            referenced = {row[0] for row in await cursor.fetchall()}
+        return await asyncio.to_thread(self._remove_unreferenced, referenced)
+
+    @staticmethod
+    def _remove_unreferenced(referenced: set) -> int:
+        cutoff = time.time() - settings.orphan_grace_period
+        removed = 0
+        with os.scandir(STATIC_DIR) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name in referenced:
+                    continue
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    # Another worker collected it first
+                    pass
+        return removed
+
+    @staticmethod
+    def _compress(message):
+        # Compressed messages are stored as BLOBs and plain ones as TEXT, so the type marks which is which
+        if message is None:
+            return None
+        encoded = message.encode('utf-8')
+        if len(encoded) < COMPRESS_MIN_SIZE:
+            return message
+        compressed = zlib.compress(encoded)
+        return compressed if len(compressed) < len(encoded) else message
+
+    @staticmethod
+    def _decompress(message):
+        if not isinstance(message, bytes):
+            return message
+        return zlib.decompress(message).decode('utf-8')
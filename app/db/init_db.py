@@ -1,16 +1,13 @@
 from fastapi import HTTPException, status
 import asyncpg
-from dotenv import load_dotenv, dotenv_values
-import os
+from app.config import settings
 
-load_dotenv()
 
-
-db_user = os.getenv("DB_USER")
-db_pwd = os.getenv("DB_PWD")
-db_name = os.getenv("DB_NAME")
-db_host = os.getenv("DB_HOST")
-db_port = os.getenv("DB_PORT")
+db_user = settings.db_user
+db_pwd = settings.db_pwd
+db_name = settings.db_name
+db_host = settings.db_host
+db_port = settings.db_port
 
 class Database:
     def __init__(self, min_size=1, max_size=10) -> None:
@@ -0,0 +1,153 @@
+import asyncio
+import fcntl
+from app.config import settings
+
+
+async def connect_chatdb(db):
+    # Per-connection setup, run by every worker
+    await db.execute("ATTACH DATABASE ? AS cold", (settings.archive_db,))
+
+
+async def migrate_chatdb(db):
+    async with db.execute("PRAGMA auto_vacuum") as cursor:
+        auto_vacuum = (await cursor.fetchone())[0]
+    if auto_vacuum != 2:
+        # Lets the archiver return freed pages in small steps instead of a full VACUUM;
+        # an existing file only switches modes after one rebuild
+        await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await db.execute("VACUUM")
+    await db.execute("PRAGMA journal_mode=WAL")
+    await db.execute("PRAGMA cold.journal_mode=WAL")
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        assign_seq = await create_hot_tables(db)
+        await create_cold_tables(db)
+        if assign_seq:
+            await assign_conversation_seqs(db)
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+
+
+async def migrate_chatdb_locked(db):
+    # Workers started without the launcher's preload (plain uvicorn) still need the schema; the
+    # first one migrates while the rest wait, and after that the migration is a cheap no-op
+    with open(f"{settings.chat_db}.migrate.lock", "w") as lock_file:
+        await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+        await migrate_chatdb(db)
+
+
+async def create_hot_tables(db) -> bool:
+    await db.execute('''
+    CREATE TABLE IF NOT EXISTS chat (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_id INTEGER NOT NULL,
+        receiver_id INTEGER NOT NULL,
+        timestamp TEXT NOT NULL,
+        uuid TEXT NOT NULL UNIQUE,
+        image TEXT,
+        message TEXT,
+        created_at INTEGER,
+        seq INTEGER
+    );
+    ''')
+    async with db.execute("PRAGMA table_info(chat)") as cursor:
+        columns = [column[1] for column in await cursor.fetchall()]
+    if 'created_at' not in columns:
+        await db.execute("ALTER TABLE chat ADD COLUMN created_at INTEGER")
+        await db.execute("UPDATE chat SET created_at = CAST(strftime('%s', 'now') AS INTEGER)")
+    assign_seq = 'seq' not in columns
+    if assign_seq:
+        await db.execute("ALTER TABLE chat ADD COLUMN seq INTEGER")
+    await db.execute('''
+    CREATE INDEX IF NOT EXISTS privatechat_sender_receiver
+    ON chat(sender_id, receiver_id);
+    ''')
+    await db.execute('''
+    CREATE INDEX IF NOT EXISTS chat_created_at
+    ON chat(created_at);
+    ''')
+    await db.execute('''
+    CREATE INDEX IF NOT EXISTS privatechat_seq
+    ON chat(sender_id, receiver_id, seq);
+    ''')
+    await db.execute('''
+    CREATE TABLE IF NOT EXISTS conversations (
+        user_a INTEGER NOT NULL,
+        user_b INTEGER NOT NULL,
+        last_seq INTEGER NOT NULL,
+        PRIMARY KEY (user_a, user_b)
+    );
+    ''')
+    # Keeps last_seq in step with every insert, and rolls back with it on a duplicate uuid
+    await db.execute('''
+    CREATE TRIGGER IF NOT EXISTS chat_conversation_seq AFTER INSERT ON chat
+    BEGIN
+        INSERT INTO conversations(user_a, user_b, last_seq)
+        VALUES (min(NEW.sender_id, NEW.receiver_id), max(NEW.sender_id, NEW.receiver_id), NEW.seq)
+        ON CONFLICT(user_a, user_b) DO UPDATE SET last_seq = excluded.last_seq;
+    END;
+    ''')
+    await db.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL UNIQUE,
+        profileimage TEXT NOT NULL,
+        password TEXT NOT NULL,
+        status TEXT DEFAULT 'Online'
+    );
+    ''')
+    return assign_seq
+
+
+async def create_cold_tables(db):
+    await db.execute('''
+    CREATE TABLE IF NOT EXISTS cold.chat_archive (
+        id INTEGER PRIMARY KEY,
+        sender_id INTEGER NOT NULL,
+        receiver_id INTEGER NOT NULL,
+        timestamp TEXT NOT NULL,
+        uuid TEXT NOT NULL,
+        image TEXT,
+        message BLOB,
+        seq INTEGER
+    );
+    ''')
+    async with db.execute("PRAGMA cold.table_info(chat_archive)") as cursor:
+        columns = [column[1] for column in await cursor.fetchall()]
+    if 'seq' not in columns:
+        await db.execute("ALTER TABLE cold.chat_archive ADD COLUMN seq INTEGER")
+    await db.execute('''
+    CREATE INDEX IF NOT EXISTS cold.chat_archive_sender ON chat_archive(sender_id);
+    ''')
+    await db.execute('''
+    CREATE INDEX IF NOT EXISTS cold.chat_archive_receiver ON chat_archive(receiver_id);
+    ''')
+    await db.execute('''
+    CREATE INDEX IF NOT EXISTS cold.chat_archive_seq ON chat_archive(sender_id, receiver_id, seq);
+    ''')
+
+
+async def assign_conversation_seqs(db):
+    numbered = '''
+        SELECT id, ROW_NUMBER() OVER (
+            PARTITION BY min(sender_id, receiver_id), max(sender_id, receiver_id) ORDER BY id
+        ) AS seq
+        FROM (
+            SELECT id, sender_id, receiver_id FROM main.chat
+            UNION ALL SELECT id, sender_id, receiver_id FROM cold.chat_archive
+        )
+    '''
+    await db.execute(f"UPDATE main.chat SET seq = numbered.seq FROM ({numbered}) AS numbered WHERE chat.id = numbered.id")
+    await db.execute(f"UPDATE cold.chat_archive SET seq = numbered.seq FROM ({numbered}) AS numbered WHERE chat_archive.id = numbered.id")
+    await db.execute('''
+        INSERT OR REPLACE INTO conversations(user_a, user_b, last_seq)
+        SELECT min(sender_id, receiver_id), max(sender_id, receiver_id), MAX(seq)
+        FROM (
+            SELECT sender_id, receiver_id, seq FROM main.chat
+            UNION ALL SELECT sender_id, receiver_id, seq FROM cold.chat_archive
+        )
+        GROUP BY 1, 2
+    ''')
+    print("Assigned conversation sequence numbers")
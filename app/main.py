@@ -7,77 +7,65 @@ from datetime import datetime
 import base64
 import asyncio
 from contextlib import asynccontextmanager
-from dotenv import load_dotenv
 import os
+from app.config import settings
+from app.db.archive import ChatArchiver
+from app.db.schema import connect_chatdb, migrate_chatdb_locked
 from app.websocket.connectionmanager import ConnectionManager
 from app.models.validations import ImageUpload
+from app.utils.ratelimit import RateLimiter
 import aiofiles
 from app.routes.chat_route import chat_router
 from app.routes.login_route import login_router
 from app.routes.signup_router import signup_router
 from app.routes.logout_router import logout_router
 from app.routes.get_users_router import get_users_router
+from app.routes.drain_router import drain_router
 
 
-load_dotenv()
-
 if not os.path.exists("./static"):
     os.makedirs("./static")
 
-SECRET_KEY = os.getenv("AUTH_SECRET")
-ALGORITHM = os.getenv("ALGORITHM")
-WEBSOCKET_TIMEOUT = int(os.getenv("WEBSOCKET_TIMEOUT"))
-REDIS_URL = os.getenv("REDIS_URL")
+WEBSOCKET_TIMEOUT = settings.websocket_timeout
+MAX_FRAME_SIZE = settings.max_frame_size
+
+rate_limiter = RateLimiter()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global manager
     global chatdb
-    async with aiosqlite.connect("pychat.db") as db:
+    global archiver
+    async with aiosqlite.connect(settings.chat_db) as db:
         chatdb = db
-        await db.execute('''
-        CREATE TABLE IF NOT EXISTS chat (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            sender_id INTEGER NOT NULL,
-            receiver_id INTEGER NOT NULL,
-            timestamp TEXT NOT NULL,
-            uuid TEXT NOT NULL UNIQUE,
-            image TEXT,
-            message TEXT
-        );
-        ''')
-        await db.execute('''
-        CREATE INDEX IF NOT EXISTS privatechat_sender_receiver 
-        ON chat(sender_id, receiver_id);
-        ''')
-        await db.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL UNIQUE,
-            profileimage TEXT NOT NULL,
-            password TEXT NOT NULL,
-            status TEXT DEFAULT 'Online'
-        );
-        ''')
-        await db.commit()
-        manager = ConnectionManager(REDIS_URL, chatdb)
+        await connect_chatdb(db)
+        await migrate_chatdb_locked(db)
+        archiver = ChatArchiver(chatdb)
+        archiver.start()
+        manager = ConnectionManager(settings.redis_url, chatdb)
         await manager.init_redis()
+        app.state.chatdb = chatdb
+        app.state.archiver = archiver
+        app.state.manager = manager
         print("Database and Redis initialized")
-        app.include_router(chat_router(chatdb))
-        app.include_router(login_router(chatdb))
-        app.include_router(signup_router(chatdb))
-        app.include_router(logout_router(chatdb))
-        app.include_router(get_users_router(chatdb))
 
         yield
-        
+
+        # Connections are already closed here; app.run drains them before uvicorn's shutdown
+        await archiver.stop()
         await manager.close_redis()
         print("Server and Redis shutting down...")
 
 app = FastAPI(lifespan=lifespan)
 app.mount('/static', StaticFiles(directory='./static'), name='static')
-
-origins = [os.getenv("AUTH_URL")]
+app.include_router(chat_router())
+app.include_router(login_router())
+app.include_router(signup_router())
+app.include_router(logout_router())
+app.include_router(get_users_router())
+app.include_router(drain_router())
+
+origins = [settings.auth_url]
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -88,12 +76,22 @@ app.add_middleware(
 
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: int):
-    await manager.connect(websocket, user_id)
+    if manager.draining:
+        await websocket.close(code=1012)
+        return
+    await manager.connect(websocket, user_id, websocket.query_params.get('resume'), websocket.query_params.get('last_frame'))
     try:
         while True:
             try:
                 data = await asyncio.wait_for(websocket.receive_text(), timeout=WEBSOCKET_TIMEOUT)
-                await handle_received_data(websocket, data)
+                # Drop floods before paying for json.loads on them
+                if not rate_limiter.allow_frame(user_id):
+                    continue
+                # The byte limit is enforced by uvicorn's ws_max_size; this catches servers started without it
+                if len(data) > MAX_FRAME_SIZE:
+                    print(f"Dropped oversized frame ({len(data)} characters) from user {user_id}")
+                    continue
+                await handle_received_data(websocket, data, user_id)
             except asyncio.TimeoutError:
                 print(f"No ping received from user {user_id}, closing WebSocket")
                 await websocket.close()
@@ -105,21 +103,28 @@ async def websocket_endpoint(websocket: WebSocket, user_id: int):
     except Exception as e:
         print(f"Error: {e}")
     finally:
+        rate_limiter.prune()
         print(f"Cleaned up connection for user {user_id}")
 
-async def handle_received_data(websocket: WebSocket, data: str):
+async def handle_received_data(websocket: WebSocket, data: str, user_id: int):
     try:
         json_data = json.loads(data)
         message_type = json_data.get('type')
 
+        if not rate_limiter.allow(user_id, message_type):
+            if message_type == 'chat':
+                # Sent once without a message_id so a flooding client doesn't get retried frames
+                await websocket.send_text(json.dumps({'type': 'msgupdate', 'uuid': json_data.get('uuid'), 'event': 'throttled'}))
+            return
+
         if message_type == 'chat':
             await handle_chat(json_data)
         elif message_type in ['typing', 'blur']:
-            await manager.typing_indicator(message_type, json_data['receiver_id'], json_data['sender_id'])
+            await manager.typing_indicator(message_type, int(json_data['receiver_id']), user_id)
         elif message_type == 'ping':
             await websocket.send_text(json.dumps({'type': 'pong', 'user_id': json_data['user_id']}))
         elif message_type == 'ack':
-            await manager.acknowledge_message(json_data['message_id'], int(json_data['receiver_id']))
+            await manager.acknowledge_message(int(json_data['message_id']), user_id)
     except json.JSONDecodeError:
         print("Received invalid JSON data")
     except KeyError as e:
@@ -141,17 +146,23 @@ async def handle_chat(json_data: dict):
             image_url = await handle_file_upload(file_data)
 
         query = '''
-            INSERT INTO chat(sender_id, receiver_id, message, timestamp, uuid, image) 
-            VALUES (?, ?, ?, ?, ?, ?) 
-            RETURNING id, sender_id, receiver_id, message, timestamp, uuid, image
+            INSERT INTO chat(sender_id, receiver_id, message, timestamp, uuid, image, created_at, seq) 
+            VALUES (?, ?, ?, ?, ?, ?, CAST(strftime('%s', 'now') AS INTEGER), COALESCE(
+                (SELECT last_seq FROM conversations WHERE user_a = min(?, ?) AND user_b = max(?, ?)), 0
+            ) + 1) 
+            RETURNING id, sender_id, receiver_id, message, timestamp, uuid, image, seq
         '''
         try:
-            async with chatdb.execute(query, (sender_id, receiver_id, message, timestamp, uuid, image_url)) as cursor:
+            # created_at is taken under the write lock, so it never runs ahead of seq order
+            params = (sender_id, receiver_id, message, timestamp, uuid, image_url,
+                      sender_id, receiver_id, sender_id, receiver_id)
+            async with chatdb.execute(query, params) as cursor:
                 chat_message = await cursor.fetchone()
                 await chatdb.commit()
             
                 if chat_message:
-                    await manager.update_msg_status(sender_id, uuid, "sent")
+                    # The sender needs the server-assigned seq too, or /sync sees its own messages as gaps
+                    await manager.update_msg_status(sender_id, uuid, "sent", id=chat_message[0], seq=chat_message[7])
 
                     if sender_id != receiver_id:
                         chat = {
@@ -161,16 +172,24 @@ async def handle_chat(json_data: dict):
                             'message': chat_message[3], 
                             'timestamp': chat_message[4], 
                             'uuid': chat_message[5], 
-                            'image': chat_message[6]
+                            'image': chat_message[6],
+                            'seq': chat_message[7]
                         }
                         await manager.send_message(chat)
                         print(f"Message sent from user {sender_id} to {receiver_id}")
 
         except aiosqlite.IntegrityError as e:
+            # A failed statement leaves its transaction open, holding the write lock the other workers need
+            await chatdb.rollback()
             if "UNIQUE constraint failed: chat.uuid" in str(e):
                 await manager.update_msg_status(sender_id, uuid, "sent")
             else:
                 raise
+        except aiosqlite.OperationalError:
+            # e.g. "database is locked" while another process holds the write lock; let the client retry
+            await chatdb.rollback()
+            await manager.update_msg_status(sender_id, uuid, "failed")
+            raise
     except Exception as e:
         print(f"Error handling chat message: {e}")
 
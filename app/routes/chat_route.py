@@ -1,60 +1,131 @@
-from fastapi import APIRouter, Depends, Path, HTTPException
+from fastapi import APIRouter, Depends, Path, Query, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from app.utils.checkapikey import check_api_key
-from dotenv import load_dotenv
+from app.utils.dependencies import get_chatdb, get_archiver
+from app.config import settings
 from jose import jwt
-import os
+import sys
 
-load_dotenv()
-
-def chat_router(chatdb):
+def chat_router():
     router = APIRouter()
-    SECRET_KEY = os.getenv("AUTH_SECRET")
-    ALGORITHM = os.getenv("ALGORITHM")
+    SECRET_KEY = settings.auth_secret
+    ALGORITHM = settings.algorithm
 
     security = HTTPBearer()
 
+    def to_message(chat, user_id: int) -> dict:
+        message = {
+            'id': chat[0], 
+            'sender_id': chat[1], 
+            'receiver_id': chat[2], 
+            'message': chat[3], 
+            'timestamp': chat[4], 
+            'uuid': chat[5], 
+            'image': chat[6],
+            'seq': chat[7],
+        }
+        if chat[1] == user_id:
+            message['status'] = 'sent'
+        return message
+
     @router.post("/load_chat/{id}")
     async def load_chat(
         id: int = Path(..., gt=0),
+        before: int = Query(None, gt=0, description="Return messages with an id lower than this"),
+        limit: int = Query(None, gt=0, le=500, description="Page size; pages past the hot window are read from the archive"),
         api_key: str = Depends(check_api_key),
-        credentials: HTTPAuthorizationCredentials = Depends(security)
+        credentials: HTTPAuthorizationCredentials = Depends(security),
+        chatdb = Depends(get_chatdb),
+        archiver = Depends(get_archiver)
     ):
         token = credentials.credentials
 
         try:
             payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
             if payload and payload['id'] == str(id):
-                query = '''
-                SELECT id, sender_id, receiver_id, message, timestamp, uuid, image
-                FROM chat 
-                WHERE sender_id = ? OR receiver_id = ? 
-                ORDER BY timestamp DESC
-                '''
-                async with chatdb.execute(query, (id, id)) as cursor:
-                    chats = await cursor.fetchall()
-                    if chats:
-                        chat_data = []
-                        for chat in chats:
-                            message = {
-                                'id': chat[0], 
-                                'sender_id': chat[1], 
-                                'receiver_id': chat[2], 
-                                'message': chat[3], 
-                                'timestamp': chat[4], 
-                                'uuid': chat[5], 
-                                'image': chat[6],
-                            }
-                            if chat[1] == id:
-                                message['status'] = 'sent'
-                            chat_data.append(message)
-                        return chat_data
-                    else:
-                        return []
+                if limit is None:
+                    query = '''
+                    SELECT id, sender_id, receiver_id, message, timestamp, uuid, image, seq
+                    FROM chat 
+                    WHERE sender_id = ? OR receiver_id = ? 
+                    ORDER BY id DESC
+                    '''
+                    params = (id, id)
+                else:
+                    query = '''
+                    SELECT id, sender_id, receiver_id, message, timestamp, uuid, image, seq
+                    FROM chat 
+                    WHERE (sender_id = ? OR receiver_id = ?) AND id < ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                    '''
+                    params = (id, id, before or sys.maxsize, limit)
+                async with chatdb.execute(query, params) as cursor:
+                    chats = list(await cursor.fetchall())
+
+                # Fall through to the archive for whatever the hot table couldn't fill;
+                # without a limit that is the rest of the history (LIMIT -1 is unbounded)
+                if limit is None or len(chats) < limit:
+                    oldest = chats[-1][0] if chats else before or sys.maxsize
+                    chats.extend(await archiver.load_chat(id, oldest, -1 if limit is None else limit - len(chats)))
+
+                return [to_message(chat, id) for chat in chats]
             else:
                 raise HTTPException(status_code=403, detail="Unauthorized")
         except Exception as e:
             print(f"Failed to load chat history for user {id}: {e}")
             raise HTTPException(status_code=500, detail="Failed to load chat history")
 
+    @router.post("/sync/{id}", description="Return messages in a conversation after a sequence number, oldest first")
+    async def sync_chat(
+        id: int = Path(..., gt=0),
+        peer: int = Query(..., gt=0, description="The other user in the conversation"),
+        since: int = Query(0, ge=0, description="The last sequence number the client has"),
+        limit: int = Query(100, gt=0, le=500),
+        api_key: str = Depends(check_api_key),
+        credentials: HTTPAuthorizationCredentials = Depends(security),
+        chatdb = Depends(get_chatdb),
+        archiver = Depends(get_archiver)
+    ):
+        token = credentials.credentials
+
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            if payload and payload['id'] == str(id):
+                bounds = '''
+                SELECT
+                    (SELECT last_seq FROM conversations WHERE user_a = min(?, ?) AND user_b = max(?, ?)),
+                    (SELECT MIN(seq) FROM (
+                        SELECT MIN(seq) AS seq FROM chat WHERE sender_id = ? AND receiver_id = ?
+                        UNION ALL SELECT MIN(seq) FROM chat WHERE sender_id = ? AND receiver_id = ?
+                    ))
+                '''
+                async with chatdb.execute(bounds, (id, peer, id, peer, id, peer, peer, id)) as cursor:
+                    last_seq, hot_min = await cursor.fetchone()
+                if not last_seq or since >= last_seq:
+                    return []
+
+                chats = []
+                # Only the range below the oldest hot row lives in the archive
+                if hot_min is None or since + 1 < hot_min:
+                    chats = await archiver.sync_chat(id, peer, since, hot_min or sys.maxsize, limit)
+
+                if len(chats) < limit and hot_min is not None:
+                    query = '''
+                    SELECT id, sender_id, receiver_id, message, timestamp, uuid, image, seq
+                    FROM chat 
+                    WHERE ((sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?)) AND seq > ? 
+                    ORDER BY seq
+                    LIMIT ?
+                    '''
+                    async with chatdb.execute(query, (id, peer, peer, id, since, limit - len(chats))) as cursor:
+                        chats.extend(await cursor.fetchall())
+
+                return [to_message(chat, id) for chat in chats]
+            else:
+                raise HTTPException(status_code=403, detail="Unauthorized")
+        except Exception as e:
+            print(f"Failed to sync chat for user {id} with {peer}: {e}")
+            raise HTTPException(status_code=500, detail="Failed to sync chat")
+
     return router
@@ -0,0 +1,13 @@
+from fastapi import APIRouter, Depends
+from app.utils.checkapikey import check_drain_key
+from app.utils.dependencies import get_manager
+
+def drain_router():
+    router = APIRouter()
+
+    @router.post("/drain", description="Stop accepting connections and hand clients off before shutdown")
+    async def drain(drain_key: str = Depends(check_drain_key), manager = Depends(get_manager)):
+        # The request lands on one worker; drain_node hands it to the rest on this host
+        await manager.drain_node()
+        return {"detail": "Draining"}
+    return router
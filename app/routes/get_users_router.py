@@ -1,11 +1,12 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from app.utils.checkapikey import check_api_key
+from app.utils.dependencies import get_chatdb
 
-def get_users_router(chatdb):
+def get_users_router():
     router = APIRouter()
 
     @router.post("/get_all_users")
-    async def get_users(api_key: str = Depends(check_api_key)):
+    async def get_users(api_key: str = Depends(check_api_key), chatdb = Depends(get_chatdb)):
         try:
             query = "SELECT id, username, profileimage, status FROM users ORDER BY id DESC"
             async with chatdb.execute(query) as cursor:
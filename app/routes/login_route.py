@@ -1,16 +1,17 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 import bcrypt
 from app.utils.checkapikey import check_api_key
+from app.utils.dependencies import get_chatdb
 from app.models.validations import LoginRequest
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
-def login_router(chatdb):
+def login_router():
     router = APIRouter()
 
     @router.post("/login", description="Login a user with their username and password")
-    async def login_endpoint(login_request: LoginRequest, api_key: str = Depends(check_api_key)):
+    async def login_endpoint(login_request: LoginRequest, api_key: str = Depends(check_api_key), chatdb = Depends(get_chatdb)):
         try:
             query = "SELECT * FROM users WHERE username = ?"
             async with chatdb.execute(query, (login_request.username.lower(),)) as cursor:
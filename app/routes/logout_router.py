@@ -1,11 +1,12 @@
 from fastapi import APIRouter, Depends, Path
 from app.utils.checkapikey import check_api_key
+from app.utils.dependencies import get_chatdb
 
-def logout_router(chatdb):
+def logout_router():
     router = APIRouter()
 
     @router.post("/logout/{id}", description="Log out a user")
-    async def logout(id: int = Path(..., description="User ID to log out", gt=0), api_key: str = Depends(check_api_key)):
+    async def logout(id: int = Path(..., description="User ID to log out", gt=0), api_key: str = Depends(check_api_key), chatdb = Depends(get_chatdb)):
         query = "UPDATE users SET status = 'Offline' WHERE id = ?"
         async with chatdb.execute(query, (id,)) as cursor:
             await chatdb.commit()
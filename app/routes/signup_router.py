@@ -2,6 +2,7 @@ from fastapi import APIRouter, Depends, HTTPException, status
 import bcrypt
 from datetime import datetime
 from app.utils.checkapikey import check_api_key
+from app.utils.dependencies import get_chatdb
 from app.models.validations import CreatUser
 from app.utils.create_avatar import avatar
 import os
@@ -17,11 +18,11 @@ def check_passwords_match(password: str, confirm_password: str):
         )
     return password
 
-def signup_router(chatdb):
+def signup_router():
     router = APIRouter()
 
     @router.post("/signup", description="Create a new user with a username and password.")
-    async def signup_endpoint(create_user: CreatUser, api_key: str = Depends(check_api_key)):
+    async def signup_endpoint(create_user: CreatUser, api_key: str = Depends(check_api_key), chatdb = Depends(get_chatdb)):
         try:
             username = create_user.username.lower()
             first_letter = username[0].upper()
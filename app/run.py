@@ -0,0 +1,53 @@
+import asyncio
+import sys
+import aiosqlite
+import uvicorn
+from uvicorn.main import STARTUP_FAILURE
+from uvicorn.supervisors import Multiprocess
+from app.config import settings
+from app.db.schema import connect_chatdb, migrate_chatdb_locked
+
+
+async def preload():
+    # Run migrations once up front so workers start against a ready schema
+    async with aiosqlite.connect(settings.chat_db) as db:
+        await connect_chatdb(db)
+        await migrate_chatdb_locked(db)
+
+
+class DrainingServer(uvicorn.Server):
+    async def shutdown(self, sockets=None):
+        # uvicorn closes every websocket with 1012 before lifespan shutdown, which would take
+        # users Offline without a resume token; hand them off while the sockets are still open
+        from app.main import app
+        manager = getattr(app.state, 'manager', None)
+        if manager and not manager.draining:
+            await manager.drain()
+        await super().shutdown(sockets)
+
+
+def main():
+    asyncio.run(preload())
+    config = uvicorn.Config(
+        "app.main:app",
+        host=settings.host,
+        port=settings.port,
+        workers=settings.workers,
+        loop=settings.loop,
+        http=settings.http,
+        timeout_graceful_shutdown=settings.graceful_shutdown_timeout,
+        # Reject oversized frames in the protocol layer instead of buffering them for the app
+        ws_max_size=settings.max_frame_size,
+    )
+    # Same as uvicorn.run, with the draining server in each worker
+    server = DrainingServer(config)
+    if config.workers > 1:
+        Multiprocess(config, target=server.run, sockets=[config.bind_socket()]).run()
+    else:
+        server.run()
+        if not server.started:
+            sys.exit(STARTUP_FAILURE)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,16 @@
+import secrets
 from fastapi import HTTPException, Security, status
 from fastapi.security import APIKeyHeader
-from dotenv import load_dotenv, dotenv_values
-import os
+from app.config import settings
 
-load_dotenv()
-
-API_KEY = os.getenv('API_KEY')
+API_KEY = settings.api_key
 api_key_header = APIKeyHeader(name='x-api-key')
+drain_key_header = APIKeyHeader(name='x-drain-key')
 
 async def check_api_key(api_key: str = Security(api_key_header)):
     if api_key != API_KEY:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Api Key")
\ No newline at end of file
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Api Key")
+
+async def check_drain_key(drain_key: str = Security(drain_key_header)):
+    if not settings.drain_key or not secrets.compare_digest(drain_key, settings.drain_key):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Drain Key")
@@ -0,0 +1,10 @@
+from fastapi import Request
+
+def get_chatdb(request: Request):
+    return request.app.state.chatdb
+
+def get_archiver(request: Request):
+    return request.app.state.archiver
+
+def get_manager(request: Request):
+    return request.app.state.manager
@@ -0,0 +1,74 @@
+import time
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def consume(self, tokens: float = 1) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def is_full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated_at) * self.refill_rate >= self.capacity
+
+
+class RateLimiter:
+    # message type -> (burst capacity, tokens refilled per second)
+    DEFAULT_LIMITS = {
+        'chat': (10, 5),
+        'typing': (5, 2),
+        'blur': (5, 2),
+        'ping': (3, 1),
+    }
+    UNKNOWN_LIMIT = (5, 1)
+    # Every frame, checked before parsing; roomy enough for acks, which have no limit of their own
+    FRAME_LIMIT = (60, 30)
+    # Not reachable from allow(), which files unknown types under None
+    FRAME_KEY = '*'
+    # Acks only pop a pending frame; dropping them would cause retransmissions
+    EXEMPT = {'ack'}
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, limits: dict = None):
+        self.limits = limits or self.DEFAULT_LIMITS
+        self.buckets: dict = {}
+        self.pruned_at = time.monotonic()
+
+    def allow(self, user_id: int, message_type: str) -> bool:
+        if message_type in self.EXEMPT:
+            return True
+        # Unknown types share one bucket so clients can't grow the dict with made-up types
+        key = message_type if message_type in self.limits else None
+        user_buckets = self.buckets.setdefault(user_id, {})
+        bucket = user_buckets.get(key)
+        if bucket is None:
+            capacity, refill_rate = self.limits.get(key, self.UNKNOWN_LIMIT)
+            bucket = user_buckets[key] = TokenBucket(capacity, refill_rate)
+        return bucket.consume()
+
+    def allow_frame(self, user_id: int) -> bool:
+        user_buckets = self.buckets.setdefault(user_id, {})
+        bucket = user_buckets.get(self.FRAME_KEY)
+        if bucket is None:
+            bucket = user_buckets[self.FRAME_KEY] = TokenBucket(*self.FRAME_LIMIT)
+        return bucket.consume()
+
+    def prune(self):
+        # Buckets outlive the connection so reconnecting doesn't refill them;
+        # a bucket that has refilled is equivalent to none and can go
+        now = time.monotonic()
+        if now - self.pruned_at < self.PRUNE_INTERVAL:
+            return
+        self.pruned_at = now
+        for user_id in [user_id for user_id, user_buckets in self.buckets.items()
+                        if all(bucket.is_full(now) for bucket in user_buckets.values())]:
+            del self.buckets[user_id]
@@ -1,45 +1,108 @@
-import uuid
+import itertools
 import time
+import random
+import secrets
+import socket
 import json
 import asyncio
 from fastapi import WebSocket
-from dotenv import load_dotenv
 import aioredis
+from app.config import settings
 
-load_dotenv()
+RESUME_SWEEP_INTERVAL = 5
+LISTEN_RETRY_DELAY = 1
+# Receivers remembered per sender for typing coalescing; the least recently used is evicted
+TYPING_PEERS_LIMIT = 32
 
 class ConnectionManager:
     def __init__(self, redis_url: str, db):
         self.redis = None
         self.redis_url = redis_url
         self.active_connections: dict = {}
+        # Both keyed by user id and reset on every connection
         self.pending_messages: dict = {}
+        self.frame_ids: dict = {}
+        self.typing_events: dict = {}
+        self.retry_tasks: set = set()
+        self.draining = False
+        self.worker_id = secrets.token_hex(8)
+        # Workers on this host share one drain channel; other hosts on the same Redis are unaffected
+        self.channels = (f"worker:{self.worker_id}", "broadcast", f"drain:{socket.gethostname()}")
+        self.pubsub = None
+        self.listener = None
+        self.sweeper = None
         self.db = db
 
     async def init_redis(self):
         try:
             self.redis = await aioredis.from_url(self.redis_url)
+            self.listener = asyncio.create_task(self._listen())
+            self.sweeper = asyncio.create_task(self._sweep_expired_resumes())
             print("Connected to Redis")
         except Exception as e:
             print(f"Failed to connect to Redis: {e}")
 
     async def close_redis(self):
+        if self.listener:
+            self.listener.cancel()
+        if self.sweeper:
+            self.sweeper.cancel()
+        if self.pubsub:
+            await self.pubsub.close()
         if self.redis:
             await self.redis.close()
             print("Redis connection closed")
 
-    async def connect(self, websocket: WebSocket, user_id: int):
+    async def _listen(self):
+        while True:
+            try:
+                self.pubsub = self.redis.pubsub()
+                await self.pubsub.subscribe(*self.channels)
+                async for event in self.pubsub.listen():
+                    if event['type'] != 'message':
+                        continue
+                    try:
+                        await self._handle_event(json.loads(event['data']))
+                    except Exception as e:
+                        print(f"Failed to handle worker channel message: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Worker channel listener lost its connection: {e}")
+            try:
+                await self.pubsub.close()
+            except Exception:
+                pass
+            await asyncio.sleep(LISTEN_RETRY_DELAY)
+
+    async def _handle_event(self, payload: dict):
+        if 'receiver_id' in payload:
+            await self._deliver_local(payload['receiver_id'], payload['frame'])
+        elif 'drain' in payload:
+            if not self.draining:
+                await self.drain()
+        elif payload['origin'] != self.worker_id:
+            await self._broadcast_local(payload['frame'], payload['exclude'])
+
+    async def connect(self, websocket: WebSocket, user_id: int, resume_token: str = None, last_frame: str = None):
         await websocket.accept()
         if user_id in self.active_connections:
             return
         self.active_connections[user_id] = websocket
+        self.frame_ids[user_id] = itertools.count(1)
+        self.pending_messages[user_id] = {}
+        await self.set_presence(user_id)
+        resumed = await self.resume_session(resume_token, user_id, last_frame)
         query = "UPDATE users SET status = 'Online' WHERE id = ? RETURNING id"
         try:
             async with self.db.execute(query, (user_id,)) as cursor:
                 result = await cursor.fetchone()
+                # Commit even when no row matched; an open write transaction would lock out the other workers
+                await self.db.commit()
                 if result:
-                    await self.db.commit()
-                    await self.notify_status_change(user_id, "Online")
+                    # Peers never saw a resumed user go offline, so don't broadcast
+                    if not resumed:
+                        await self.notify_status_change(user_id, "Online")
                     await self.send_undelivered_messages(user_id)
         except Exception as e:
             print(f"Failed to connect user {user_id}: {e}")
@@ -49,23 +112,31 @@ class ConnectionManager:
         if user_id not in self.active_connections:
             return
         self.active_connections.pop(user_id)
+        self.frame_ids.pop(user_id, None)
+        pending = self.pending_messages.pop(user_id, {})
+        self.typing_events.pop(user_id, None)
+        await self.clear_presence(user_id)
+        for message_id, message in pending.items():
+            if json.loads(message).get("type") == "chat":
+                await self.store_in_redis(user_id, message_id, message)
         query = "UPDATE users SET status = 'Offline' WHERE id = ? RETURNING id"
         try:
             async with self.db.execute(query, (user_id,)) as cursor:
                 result = await cursor.fetchone()
+                await self.db.commit()
                 if result:
-                    await self.db.commit()
-                    await self.notify_status_change(user_id, "Offline")
+                    if not self.draining:
+                        await self.notify_status_change(user_id, "Offline")
         except Exception as e:
             print(f"Failed to disconnect user {user_id}: {e}")
             await self.db.rollback()
 
-    async def store_in_redis(self, receiver_id: int, message_id: str, message: str):
+    async def store_in_redis(self, receiver_id: int, message_id: int, message: str):
         try:
-            message_id = str(message_id)
-            await self.redis.hset(f"undelivered:{receiver_id}", message_id, message)
-            if message_id in self.pending_messages:
-                del self.pending_messages[message_id]
+            # Keyed by chat row id; the frame id is reassigned when the message is replayed
+            chat_id = json.loads(message)['id']
+            await self.redis.hset(f"undelivered:{receiver_id}", chat_id, message)
+            self.pending_messages.get(receiver_id, {}).pop(message_id, None)
         except Exception as e:
             print(f"Error storing message in Redis for receiver {receiver_id}, message_id {message_id}: {e}")
 
@@ -76,95 +147,229 @@ class ConnectionManager:
             print(f"Failed to retrieve undelivered messages for user {user_id}: {e}")
             return {}
 
-    async def delete_message_from_redis(self, receiver_id: int, message_id: str):
+    async def delete_message_from_redis(self, receiver_id: int, chat_id: int):
         try:
-            await self.redis.hdel(f"undelivered:{receiver_id}", message_id)
+            await self.redis.hdel(f"undelivered:{receiver_id}", chat_id)
         except Exception as e:
-            print(f"Failed to delete message {message_id} from Redis for user {receiver_id}: {e}")
+            print(f"Failed to delete message {chat_id} from Redis for user {receiver_id}: {e}")
 
-    async def send_message(self, result):
-        websocket = self.active_connections.get(result['receiver_id'])
-        message_id = self.generate_message_id()
-        message = json.dumps({'type': 'chat', 'message_id': message_id, **result})
+    async def set_presence(self, user_id: int):
+        try:
+            await self.redis.set(f"presence:{user_id}", self.worker_id)
+        except Exception as e:
+            print(f"Failed to set presence for user {user_id}: {e}")
 
-        if websocket:
-            await self.queue_message(result['receiver_id'], message, message_id)
-        else:
-            await self.store_in_redis(result['receiver_id'], message_id, message)
+    async def clear_presence(self, user_id: int):
+        try:
+            key = f"presence:{user_id}"
+            owner = await self.redis.get(key)
+            # The user may already have reconnected through another worker
+            if owner is not None and owner.decode() == self.worker_id:
+                await self.redis.delete(key)
+        except Exception as e:
+            print(f"Failed to clear presence for user {user_id}: {e}")
+
+    async def resume_session(self, resume_token: str, user_id: int, last_frame: str = None) -> bool:
+        if not resume_token:
+            return False
+        try:
+            key = f"resume:{resume_token}"
+            record = await self.redis.get(key)
+            await self.redis.delete(key)
+            if record is None:
+                return False
+            record = json.loads(record)
+            if record['user_id'] != user_id:
+                return False
+            await self.redis.zrem("resume:pending", user_id)
+            # Chats flushed at drain time that the client had already received
+            # on the old connection would otherwise be replayed as duplicates
+            if last_frame is not None:
+                received = [chat_id for chat_id, message_id in record['flushed'].items() if message_id <= int(last_frame)]
+                if received:
+                    await self.redis.hdel(f"undelivered:{user_id}", *received)
+            return True
+        except Exception as e:
+            print(f"Failed to resume session for user {user_id}: {e}")
+            return False
+
+    async def _sweep_expired_resumes(self):
+        # Drained users who never came back would otherwise look Online to their peers forever
+        while True:
+            await asyncio.sleep(RESUME_SWEEP_INTERVAL)
+            if self.draining:
+                continue
+            try:
+                for user_id in await self.redis.zrangebyscore("resume:pending", 0, time.time()):
+                    # Only the worker whose zrem succeeds broadcasts
+                    if await self.redis.zrem("resume:pending", user_id):
+                        if not await self.redis.exists(f"presence:{int(user_id)}"):
+                            await self.notify_status_change(int(user_id), "Offline")
+            except Exception as e:
+                print(f"Failed to sweep expired resume tokens: {e}")
+
+    async def drain_node(self):
+        if not self.draining:
+            await self.drain()
+        try:
+            await self.redis.publish(self.channels[2], json.dumps({'drain': self.worker_id}))
+        except Exception as e:
+            print(f"Failed to signal drain to the other workers: {e}")
 
-    async def update_msg_status(self, user_id: int, uuid: str, event: str):
+    async def drain(self):
+        self.draining = True
+        for task in list(self.retry_tasks):
+            task.cancel()
+
+        flushed: dict = {}
+        for receiver_id, pending in list(self.pending_messages.items()):
+            for message_id, message in list(pending.items()):
+                frame = json.loads(message)
+                if frame.get("type") == "chat":
+                    await self.store_in_redis(receiver_id, message_id, message)
+                    flushed.setdefault(receiver_id, {})[frame['id']] = message_id
+                else:
+                    pending.pop(message_id, None)
+
+        connections = list(self.active_connections.items())
+        for user_id, websocket in connections:
+            try:
+                resume_token = secrets.token_urlsafe(16)
+                record = json.dumps({'user_id': user_id, 'flushed': flushed.get(user_id, {})})
+                await self.redis.set(f"resume:{resume_token}", record, ex=settings.resume_token_ttl)
+                await self.redis.zadd("resume:pending", {user_id: time.time() + settings.resume_token_ttl})
+                delay = int(random.uniform(0, settings.drain_reconnect_window) * 1000)
+                await websocket.send_text(json.dumps({'type': 'reconnect', 'delay': delay, 'resume_token': resume_token}))
+                await websocket.close(code=1012)
+            except Exception as e:
+                print(f"Failed to drain connection for user {user_id}: {e}")
+        print(f"Drained {len(connections)} connections")
+
+    async def deliver(self, receiver_id: int, frame: dict):
+        if receiver_id in self.active_connections:
+            await self._deliver_local(receiver_id, frame)
+            return
+        try:
+            worker_id = await self.redis.get(f"presence:{receiver_id}")
+            if worker_id is not None and worker_id.decode() != self.worker_id:
+                # publish returns the subscriber count; 0 means that worker is gone
+                payload = json.dumps({'receiver_id': receiver_id, 'frame': frame})
+                if await self.redis.publish(f"worker:{worker_id.decode()}", payload):
+                    return
+        except Exception as e:
+            print(f"Failed to route message to user {receiver_id}: {e}")
+        if frame['type'] == 'chat':
+            await self.store_in_redis(receiver_id, None, json.dumps(frame))
+
+    async def _deliver_local(self, receiver_id: int, frame: dict):
+        if receiver_id in self.active_connections:
+            message_id = self.generate_message_id(receiver_id)
+            await self.queue_message(receiver_id, json.dumps({**frame, 'message_id': message_id}), message_id)
+        elif frame['type'] == 'chat':
+            await self.store_in_redis(receiver_id, None, json.dumps(frame))
+
+    async def send_message(self, result):
+        await self.deliver(result['receiver_id'], {'type': 'chat', **result})
+
+    async def update_msg_status(self, user_id: int, uuid: str, event: str, **fields):
         websocket = self.active_connections.get(user_id)
         if websocket:
-            message_id = self.generate_message_id()
-            message = json.dumps({'type': 'msgupdate', 'uuid': uuid, 'event': event, 'message_id': message_id})
+            message_id = self.generate_message_id(user_id)
+            message = json.dumps({'type': 'msgupdate', 'uuid': uuid, 'event': event, **fields, 'message_id': message_id})
             await self.queue_message(user_id, message, message_id)
 
     async def typing_indicator(self, type: str, receiver_id: int, sender_id: int):
-        websocket = self.active_connections.get(receiver_id)
-        if websocket:
-            try:
-                message_id = self.generate_message_id()
-                message = json.dumps({'type': type, 'sender_id': sender_id, 'message_id': message_id})
-                await self.queue_message(receiver_id, message, message_id)
-            except Exception as e:
-                print(f"Failed to send typing indicator to {receiver_id}: {e}")
+        # Forward at most one event per sender->receiver per window unless the state flips;
+        # this runs before delivery so repeats never reach the presence lookup in Redis
+        now = time.monotonic()
+        sent = self.typing_events.setdefault(sender_id, {})
+        last = sent.pop(receiver_id, None)
+        if last and last[0] == type and now - last[1] < settings.typing_coalesce_window:
+            sent[receiver_id] = last
+            return
+        if len(sent) >= TYPING_PEERS_LIMIT:
+            sent.pop(next(iter(sent)))
+        sent[receiver_id] = (type, now)
+        try:
+            # Local receivers are delivered without touching Redis
+            await self.deliver(receiver_id, {'type': type, 'sender_id': sender_id})
+        except Exception as e:
+            print(f"Failed to send typing indicator to {receiver_id}: {e}")
 
-    async def acknowledge_message(self, message_id: str, receiver_id: int):
-        if message_id in self.pending_messages:
-            del self.pending_messages[message_id]
+    async def acknowledge_message(self, message_id: int, receiver_id: int):
+        self.pending_messages.get(receiver_id, {}).pop(message_id, None)
 
     async def send_undelivered_messages(self, user_id: int):
         undelivered_messages = await self.retrieve_undelivered_messages(user_id)
-        for message_id, message in undelivered_messages.items():
-            if isinstance(message, bytes):
-                message = message.decode('utf-8')
+        chats = []
+        for index, (field, message) in enumerate(undelivered_messages.items()):
             try:
-                id = json.loads(message)
-                await self.queue_message(user_id, message, id['message_id'])
-                await self.delete_message_from_redis(user_id, message_id)
-            except json.JSONDecodeError as e:
-                print(f"Failed to decode message with ID {message_id}: {e}")
-
-    async def queue_message(self, receiver_id: int, message: str, message_id: str, retries: int = 5, retry_interval: int = 2):
-        self.pending_messages[message_id] = message
-        websocket = self.active_connections.get(receiver_id)
-        if websocket:
-            asyncio.create_task(self._retry_send_message(receiver_id, message, message_id, retries, retry_interval))
+                chat = json.loads(message)
+                # Hashes written before chat-id keys use "<uuid4>-<epoch>" fields,
+                # so order by the chat row id in the payload, then insertion order
+                chat_id = chat.get('id')
+                chats.append((chat_id if isinstance(chat_id, int) else float('inf'), index, field, chat))
+            except Exception as e:
+                print(f"Failed to decode message with ID {field}: {e}")
 
-    async def _retry_send_message(self, receiver_id: int, message: str, message_id: str, retries: int, retry_interval: int):
+        for _, _, field, chat in sorted(chats, key=lambda item: item[:2]):
+            message_id = self.generate_message_id(user_id)
+            await self.queue_message(user_id, json.dumps({**chat, 'message_id': message_id}), message_id)
+            await self.delete_message_from_redis(user_id, field)
+
+    async def queue_message(self, receiver_id: int, message: str, message_id: int, retries: int = 5, retry_interval: int = 2):
+        if self.draining:
+            if json.loads(message).get("type") == "chat":
+                await self.store_in_redis(receiver_id, message_id, message)
+            return
+        pending = self.pending_messages.get(receiver_id)
+        if pending is None:
+            if json.loads(message).get("type") == "chat":
+                await self.store_in_redis(receiver_id, message_id, message)
+            return
+        pending[message_id] = message
+        if receiver_id in self.active_connections:
+            task = asyncio.create_task(self._retry_send_message(receiver_id, message, message_id, retries, retry_interval))
+            self.retry_tasks.add(task)
+            task.add_done_callback(self.retry_tasks.discard)
+
+    async def _retry_send_message(self, receiver_id: int, message: str, message_id: int, retries: int, retry_interval: int):
         retry_count = 0
         while retry_count < retries:
+            # Gone means acked, or the connection ended and disconnect() took over;
+            # a different object under the same id belongs to a newer connection
+            if self.pending_messages.get(receiver_id, {}).get(message_id) is not message:
+                return
             try:
-                websocket = self.active_connections.get(receiver_id)
-                if websocket:
-                    await websocket.send_text(message)
-                    await asyncio.sleep(retry_interval * (2 ** retry_count))
-
-                    if message_id not in self.pending_messages:
-                        return
-
-                    retry_count += 1
-                else:
-                    if json.loads(message).get("type") == "chat":
-                        await self.store_in_redis(receiver_id, message_id, message)
-                    break
+                await self.active_connections[receiver_id].send_text(message)
             except Exception as e:
                 print(f"Failed to send message {message_id} to {receiver_id}: {e}")
                 break
+            await asyncio.sleep(retry_interval * (2 ** retry_count))
+            retry_count += 1
 
-        if message_id in self.pending_messages:
+        pending = self.pending_messages.get(receiver_id, {})
+        if pending.get(message_id) is message:
             if json.loads(message).get("type") == "chat":
                 await self.store_in_redis(receiver_id, message_id, message)
             else:
-                del self.pending_messages[message_id]
+                del pending[message_id]
 
-    def generate_message_id(self) -> str:
-        return f"{uuid.uuid4()}-{int(time.time())}"
+    def generate_message_id(self, receiver_id: int) -> int:
+        # Starts at 1 on every connection with no gaps, so clients can spot missed frames
+        # and reset their dedupe state on reconnect; acks are matched per receiver
+        return next(self.frame_ids[receiver_id])
 
     async def notify_status_change(self, user_id: int, status: str):
-        message_id = self.generate_message_id()
-        message = json.dumps({'type': 'status', 'user_id': user_id, 'status': status, 'message_id': message_id})
+        frame = {'type': 'status', 'user_id': user_id, 'status': status}
+        await self._broadcast_local(frame, user_id)
+        try:
+            await self.redis.publish("broadcast", json.dumps({'origin': self.worker_id, 'frame': frame, 'exclude': user_id}))
+        except Exception as e:
+            print(f"Failed to broadcast status change for user {user_id}: {e}")
 
-        for connection_id in self.active_connections.keys():
-            if connection_id != user_id:
-                await self.queue_message(connection_id, message, message_id)
+    async def _broadcast_local(self, frame: dict, exclude: int):
+        for connection_id in list(self.active_connections.keys()):
+            if connection_id != exclude and connection_id in self.frame_ids:
+                message_id = self.generate_message_id(connection_id)
+                await self.queue_message(connection_id, json.dumps({**frame, 'message_id': message_id}), message_id)
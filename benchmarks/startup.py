@@ -0,0 +1,83 @@
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+RUNS = int(os.getenv("BENCH_RUNS", 5))
+PORT = int(os.getenv("BENCH_PORT", 8765))
+READY_TIMEOUT = 60
+
+
+def time_import() -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import app.main"], check=True)
+    return time.perf_counter() - start
+
+
+def start_server(workers: int, data_dir: str, **kwargs) -> subprocess.Popen:
+    # Fresh databases per run, so the benchmark never migrates or vacuums a real pychat.db
+    env = {**os.environ, "PORT": str(PORT), "WEB_CONCURRENCY": str(workers),
+           "CHAT_DB": os.path.join(data_dir, "chat.db"), "ARCHIVE_DB": os.path.join(data_dir, "archive.db")}
+    return subprocess.Popen([sys.executable, "-m", "app.run"], env=env, **kwargs)
+
+
+def stop_server(server: subprocess.Popen):
+    server.terminate()
+    server.wait()
+
+
+def time_first_response(workers: int) -> float:
+    with tempfile.TemporaryDirectory() as data_dir:
+        start = time.perf_counter()
+        server = start_server(workers, data_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while time.perf_counter() - start < READY_TIMEOUT:
+                try:
+                    urllib.request.urlopen(f"http://127.0.0.1:{PORT}/openapi.json", timeout=1)
+                    return time.perf_counter() - start
+                except OSError:
+                    time.sleep(0.05)
+            raise RuntimeError("Server did not become ready")
+        finally:
+            stop_server(server)
+
+
+def time_all_ready(workers: int) -> float:
+    # Any one worker can answer the first request; count each worker's startup line instead
+    with tempfile.TemporaryDirectory() as data_dir:
+        start = time.perf_counter()
+        server = start_server(workers, data_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        ready = threading.Event()
+
+        def watch():
+            started = 0
+            for line in server.stderr:
+                if "Application startup complete" in line:
+                    started += 1
+                    if started == workers:
+                        ready.set()
+
+        threading.Thread(target=watch, daemon=True).start()
+        try:
+            if not ready.wait(READY_TIMEOUT):
+                raise RuntimeError("Workers did not become ready")
+            return time.perf_counter() - start
+        finally:
+            stop_server(server)
+
+
+def report(name: str, samples: list):
+    print(f"{name}: median {statistics.median(samples) * 1000:.0f} ms, "
+          f"min {min(samples) * 1000:.0f} ms, max {max(samples) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    report("import app.main", [time_import() for _ in range(RUNS)])
+    report("first response (1 worker)", [time_first_response(1) for _ in range(RUNS)])
+    workers = os.cpu_count() or 1
+    report(f"first response, fastest of {workers} workers", [time_first_response(workers) for _ in range(RUNS)])
+    report(f"all {workers} workers ready", [time_all_ready(workers) for _ in range(RUNS)])
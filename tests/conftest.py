@@ -0,0 +1,4 @@
+import os
+
+# app.config validates the environment on import
+os.environ.setdefault("WEBSOCKET_TIMEOUT", "30")
@@ -0,0 +1,87 @@
+import pytest
+from app.utils import ratelimit
+from app.utils.ratelimit import RateLimiter, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_allows_burst_then_refills(clock):
+    bucket = TokenBucket(3, 1)
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+    clock.now += 1
+    assert bucket.consume()
+    assert not bucket.consume()
+
+
+def test_bucket_refill_is_capped(clock):
+    bucket = TokenBucket(2, 1)
+    bucket.consume()
+    clock.now += 100
+    assert bucket.is_full(clock.now)
+    assert [bucket.consume() for _ in range(3)] == [True, True, False]
+
+
+def test_limits_are_per_user_and_type(clock):
+    limiter = RateLimiter({'chat': (2, 1), 'typing': (1, 1)})
+    assert [limiter.allow(1, 'chat') for _ in range(3)] == [True, True, False]
+    assert limiter.allow(1, 'typing')
+    assert limiter.allow(2, 'chat')
+
+
+def test_acks_are_exempt(clock):
+    limiter = RateLimiter({'chat': (1, 1)})
+    assert all(limiter.allow(1, 'ack') for _ in range(100))
+    assert 'ack' not in limiter.buckets.get(1, {})
+
+
+def test_unknown_types_share_one_bucket(clock):
+    limiter = RateLimiter({'chat': (1, 1)})
+    allowed = [limiter.allow(1, f'made-up-{i}') for i in range(RateLimiter.UNKNOWN_LIMIT[0] + 1)]
+    assert allowed[-1] is False
+    assert list(limiter.buckets[1]) == [None]
+
+
+def test_frame_bucket_is_separate_from_type_buckets(clock):
+    limiter = RateLimiter({'chat': (1, 1)})
+    capacity = RateLimiter.FRAME_LIMIT[0]
+    assert all(limiter.allow_frame(1) for _ in range(capacity))
+    assert not limiter.allow_frame(1)
+    assert limiter.allow(1, 'chat')
+    assert limiter.allow(1, RateLimiter.FRAME_KEY)
+    assert not limiter.allow_frame(1)
+
+
+def test_prune_drops_only_refilled_users(clock):
+    limiter = RateLimiter({'chat': (2, 0.1)})
+    limiter.allow(1, 'chat')
+    clock.now += RateLimiter.PRUNE_INTERVAL - 1
+    limiter.allow(2, 'chat')
+    limiter.allow(2, 'chat')
+    limiter.prune()
+    assert set(limiter.buckets) == {1, 2}
+
+    clock.now += 1
+    limiter.prune()
+    assert set(limiter.buckets) == {2}
+
+
+def test_reconnecting_does_not_refill(clock):
+    limiter = RateLimiter({'chat': (1, 1)})
+    assert limiter.allow(1, 'chat')
+    clock.now += RateLimiter.PRUNE_INTERVAL
+    limiter.allow(1, 'chat')
+    limiter.prune()
+    assert not limiter.allow(1, 'chat')
@@ -0,0 +1,100 @@
+import asyncio
+import aiosqlite
+import pytest
+from app.db.schema import assign_conversation_seqs, create_cold_tables, create_hot_tables
+
+# Same statement as handle_chat
+INSERT_CHAT = '''
+    INSERT INTO chat(sender_id, receiver_id, message, timestamp, uuid, image, created_at, seq)
+    VALUES (?, ?, ?, 't', ?, NULL, CAST(strftime('%s', 'now') AS INTEGER), COALESCE(
+        (SELECT last_seq FROM conversations WHERE user_a = min(?, ?) AND user_b = max(?, ?)), 0
+    ) + 1)
+    RETURNING seq
+'''
+
+
+def run(test):
+    async def wrapper():
+        async with aiosqlite.connect(":memory:") as db:
+            await db.execute("ATTACH DATABASE ':memory:' AS cold")
+            await test(db)
+    asyncio.run(wrapper())
+
+
+async def insert_chat(db, sender_id, receiver_id, uuid):
+    async with db.execute(INSERT_CHAT, (sender_id, receiver_id, 'hi', uuid, sender_id, receiver_id, sender_id, receiver_id)) as cursor:
+        seq = (await cursor.fetchone())[0]
+    await db.commit()
+    return seq
+
+
+async def last_seqs(db):
+    async with db.execute("SELECT user_a, user_b, last_seq FROM conversations ORDER BY 1, 2") as cursor:
+        return [tuple(row) for row in await cursor.fetchall()]
+
+
+def test_seq_counts_per_conversation_in_both_directions():
+    async def test(db):
+        await create_hot_tables(db)
+        seqs = [await insert_chat(db, sender, receiver, str(i))
+                for i, (sender, receiver) in enumerate([(1, 2), (2, 1), (1, 3), (1, 2), (3, 1)])]
+        assert seqs == [1, 2, 1, 3, 2]
+        assert await last_seqs(db) == [(1, 2, 3), (1, 3, 2)]
+    run(test)
+
+
+def test_duplicate_uuid_leaves_no_gap():
+    async def test(db):
+        await create_hot_tables(db)
+        await insert_chat(db, 1, 2, 'a')
+        with pytest.raises(aiosqlite.IntegrityError):
+            await insert_chat(db, 2, 1, 'a')
+        await db.rollback()
+        assert await last_seqs(db) == [(1, 2, 1)]
+        assert await insert_chat(db, 2, 1, 'b') == 2
+    run(test)
+
+
+def test_backfill_numbers_hot_and_archived_rows_by_id():
+    async def test(db):
+        # Tables as they were before created_at, seq and the archive's seq column existed
+        await db.execute('''
+        CREATE TABLE chat (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            uuid TEXT NOT NULL UNIQUE,
+            image TEXT,
+            message TEXT
+        )''')
+        await db.execute('''
+        CREATE TABLE cold.chat_archive (
+            id INTEGER PRIMARY KEY,
+            sender_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            uuid TEXT NOT NULL,
+            image TEXT,
+            message BLOB
+        )''')
+        await db.executemany("INSERT INTO cold.chat_archive VALUES (?, ?, ?, 't', ?, NULL, NULL)",
+                             [(1, 1, 2, 'a'), (2, 3, 1, 'b'), (4, 2, 1, 'd')])
+        await db.executemany("INSERT INTO chat VALUES (?, ?, ?, 't', ?, NULL, 'hi')",
+                             [(3, 1, 2, 'c'), (5, 1, 3, 'e'), (6, 2, 1, 'f')])
+
+        assert await create_hot_tables(db)
+        await create_cold_tables(db)
+        await assign_conversation_seqs(db)
+        await db.commit()
+
+        async with db.execute('''
+            SELECT id, seq FROM main.chat UNION ALL SELECT id, seq FROM cold.chat_archive ORDER BY id
+        ''') as cursor:
+            assert [tuple(row) for row in await cursor.fetchall()] == [(1, 1), (2, 1), (3, 2), (4, 3), (5, 2), (6, 4)]
+        async with db.execute("SELECT COUNT(*) FROM chat WHERE created_at IS NULL") as cursor:
+            assert (await cursor.fetchone())[0] == 0
+        assert await last_seqs(db) == [(1, 2, 4), (1, 3, 2)]
+        assert not await create_hot_tables(db)
+        assert await insert_chat(db, 1, 2, 'g') == 5
+    run(test)